@@ -177,6 +177,14 @@ def add_bert_features_tiered(dataset, tokenizer, seq_length, add_segment_ids=Fal
   # print(len(dataset['train'][0]['stories'])) 
   # print(len(dataset['train'][0]['stories'][0]['sentences'])) 
   max_story_length = max([len(ex['sentences']) for p in dataset for ex_2s in dataset[p] for ex in ex_2s['stories']])
+
+  # Paired stories share most of their sentences, and entity names recur across stories, so tokenize each unique
+  # sentence and entity name once for the whole dataset (in one batched call)
+  texts = [sent for p in dataset for ex_2s in dataset[p] for ex in ex_2s['stories'] for sent in ex['sentences']]
+  texts += [ent['entity'] for p in dataset for ex_2s in dataset[p] for ex in ex_2s['stories'] for ent in ex['entities']]
+  texts = list(dict.fromkeys(texts))
+  text_ids = dict(zip(texts, tokenizer(texts, add_special_tokens=False)['input_ids']))
+
   for p in dataset:
     bar_size = len(dataset[p])
     bar = progressbar.ProgressBar(max_value=bar_size, widgets=[progressbar.Bar('=', '[', ']'), ' ', progressbar.Percentage()])
@@ -184,8 +192,11 @@ def add_bert_features_tiered(dataset, tokenizer, seq_length, add_segment_ids=Fal
     bar.start()
     for i, ex_2s in enumerate(dataset[p]):
       for s_idx, ex_1s in enumerate(ex_2s['stories']):
+        sentence_ids = [text_ids[sent] for sent in ex_1s['sentences']]
+
         for ent_idx, ex in enumerate(ex_1s['entities']):
           exid = ex['example_id']
+          entity_ids = text_ids[ex['entity']]
 
           # Generate inputs for each sentence
           all_input_ids = np.zeros((max_story_length, seq_length))
@@ -193,12 +204,12 @@ def add_bert_features_tiered(dataset, tokenizer, seq_length, add_segment_ids=Fal
           if add_segment_ids:
             all_segment_ids = np.zeros((max_story_length, seq_length))
 
-          for j, sent in enumerate(ex['sentences']):
-            inputs = tokenizer.encode_plus(ex['entity'], 
-                                          text_pair=sent, 
-                                          add_special_tokens=True, 
-                                          max_length=seq_length, 
-                                          truncation=True)
+          for j, sent_ids in enumerate(sentence_ids):
+            inputs = tokenizer.prepare_for_model(entity_ids, 
+                                                 pair_ids=sent_ids, 
+                                                 add_special_tokens=True, 
+                                                 max_length=seq_length, 
+                                                 truncation=True)
             input_ids = inputs['input_ids']
 
             if add_segment_ids and 'token_type_ids' in inputs:
@@ -1,19 +1,22 @@
 import numpy as np
 import time
-from www.utils import format_time, read_tsv
+from www.utils import format_time, read_tsv, get_batch_length, LengthSortedSampler
 import torch
 import json
 import os
 import progressbar
 from www.dataset.ann import att_default_values
 
+# inference_mode (PyTorch 1.9+) also skips autograd's version counting and view tracking; fall back to no_grad
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
 # Run evaluation for a PyTorch model
-def evaluate(model, eval_dataloader, device, metrics, list_output=False, num_outputs=1, span_mode=False, seg_mode=False, return_softmax=False, multilabel=False, lm=False):
+def evaluate(model, eval_dataloader, device, metrics, list_output=False, num_outputs=1, span_mode=False, seg_mode=False, return_softmax=False, multilabel=False, lm=False, fp16=False):
   print('\tBeginning evaluation...')
 
   t0 = time.time()
 
-  model.zero_grad()
+  model.zero_grad(set_to_none=True)
   model.eval()
 
   all_labels = None
@@ -28,8 +31,11 @@ def evaluate(model, eval_dataloader, device, metrics, list_output=False, num_out
   # Get preds from model
   for batch in eval_dataloader:
     
+    # Measure before moving to GPU, so this doesn't force a device sync
+    batch_length = get_batch_length(batch[1])
+
     # Move to GPU
-    batch = tuple(t.to(device) for t in batch)
+    batch = tuple(t.to(device, non_blocking=True) for t in batch)
 
     if span_mode:
       input_ids, input_mask, labels, spans = batch
@@ -38,7 +44,15 @@ def evaluate(model, eval_dataloader, device, metrics, list_output=False, num_out
     else:
       input_ids, input_mask, labels = batch
 
-    with torch.no_grad():
+    # Drop padding columns shared by the whole batch (LM labels are per-token, so keep them aligned)
+    if not lm:
+      input_ids = input_ids[..., :batch_length]
+      input_mask = input_mask[..., :batch_length]
+      if seg_mode:
+        segment_ids = segment_ids[..., :batch_length]
+
+    # fp16: run the forward pass under autocast (mixed precision)
+    with inference_mode(), torch.cuda.amp.autocast(enabled=fp16):
       if span_mode:
         out = model(input_ids,
                     token_type_ids=None,
@@ -61,6 +75,8 @@ def evaluate(model, eval_dataloader, device, metrics, list_output=False, num_out
     # print(all_labels.shape)
 
     logits = out[0]
+    if fp16 and not list_output:
+      logits = logits.float()
     if list_output: # This is broken, do not use
       metr = {}
       for o in range(num_outputs):
@@ -104,6 +120,13 @@ def evaluate(model, eval_dataloader, device, metrics, list_output=False, num_out
         else:
           all_logits = np.concatenate((all_logits, logits))
 
+  # If examples were visited in order of length, put outputs back in dataset order
+  if isinstance(getattr(eval_dataloader, 'sampler', None), LengthSortedSampler) and not list_output:
+    all_labels = eval_dataloader.sampler.restore_order(all_labels)
+    all_preds = eval_dataloader.sampler.restore_order(all_preds)
+    if return_softmax:
+      all_logits = eval_dataloader.sampler.restore_order(all_logits)
+
   # Calculate metrics
   print('\t\tComputing metrics...')
   if multilabel:
@@ -215,36 +238,57 @@ def list_comparison(pred, label):
 
   return prec, rec, corr, perf
 
+# Concatenate a list of per-batch tensors and copy them to the CPU in one transfer (None if the list is empty)
+def concat_to_numpy(tensors):
+  if len(tensors) == 0:
+    return None
+  return torch.cat(tensors, dim=0).detach().cpu().numpy()
+
+# Collate every batch of a TRIP evaluation DataLoader and move it to the device once, so evaluations repeated across
+# training epochs only run forward passes. Each batch is stored with its padding trim length (measured on the CPU) and with
+# token ids and labels cast to long (on the device, after copying the pinned batch). The returned list can be passed to
+# evaluate_tiered in place of the DataLoader.
+def preload_batches(eval_dataloader, device):
+  long_idx = [0, 4, 5, 6, 7, 8] # input_ids, attributes, preconditions, effects, conflicts, labels
+  preloaded = []
+  for batch in eval_dataloader:
+    batch_length = get_batch_length(batch[3])
+    batch = tuple(t.to(device, non_blocking=True) for t in batch)
+    preloaded.append((batch_length, tuple(t.long() if i in long_idx else t for i, t in enumerate(batch))))
+  return preloaded
+
 # Run evaluation for the conflict detector
-def evaluate_tiered(model, eval_dataloader, device, metrics, seg_mode=False, return_softmax=False, return_explanations=False, return_losses=False, verbose=True):
+def evaluate_tiered(model, eval_dataloader, device, metrics, seg_mode=False, return_softmax=False, return_explanations=False, return_losses=False, verbose=True, fp16=False):
   if verbose:
     print('\tBeginning evaluation...')
 
   t0 = time.time()
 
-  model.zero_grad()
+  model.zero_grad(set_to_none=True)
   model.eval()
   for layer in model.precondition_classifiers:
     layer.eval()
   for layer in model.effect_classifiers:
     layer.eval()    
 
-  all_pred_attributes = None
-  all_attributes = None
+  # Labels are collected from the input batches (on the CPU, or on the device if preloaded) and predictions are kept on
+  # the device, then all are copied to the CPU once at the end
+  all_pred_attributes = []
+  all_attributes = []
 
-  all_pred_prec = None
-  all_prec = None
+  all_pred_prec = []
+  all_prec = []
 
-  all_pred_eff = None
-  all_eff = None
+  all_pred_eff = []
+  all_eff = []
 
-  all_pred_conflicts = None
-  all_conflicts = None
+  all_pred_conflicts = []
+  all_conflicts = []
 
-  all_pred_stories = None
-  all_stories = None  
+  all_pred_stories = []
+  all_stories = []
   if return_softmax:
-    all_prob_stories = None
+    all_prob_stories = []
   
   if verbose:
     print('\t\tRunning prediction...')
@@ -260,26 +304,39 @@ def evaluate_tiered(model, eval_dataloader, device, metrics, seg_mode=False, ret
 
   # Get preds from model
   for batch in eval_dataloader:
-    # Move to GPU
-    batch = tuple(t.to(device) for t in batch)
-
-    input_ids = batch[0].long().to(device)
-    input_lengths = batch[1].to(device)
-    input_entities = batch[2].to(device)
-    input_mask = batch[3].to(device)
-    attributes = batch[4].long().to(device)
-    preconditions = batch[5].long().to(device)
-    effects = batch[6].long().to(device)
-    conflicts = batch[7].long().to(device)
-    labels = batch[8].long().to(device)
+    if isinstance(batch[0], int): # Preloaded by preload_batches, already on the device
+      batch_length, batch = batch
+      label_batch = batch
+    else:
+      batch_length = get_batch_length(batch[3])
+
+      # Move to GPU
+      label_batch = batch
+      batch = tuple(t.to(device, non_blocking=True) for t in batch)
+
+    input_ids = batch[0].long()
+    input_lengths = batch[1]
+    input_entities = batch[2]
+    input_mask = batch[3]
+    attributes = batch[4].long()
+    preconditions = batch[5].long()
+    effects = batch[6].long()
+    conflicts = batch[7].long()
+    labels = batch[8].long()
     if seg_mode:
-      segment_ids = batch[9].to(device)
+      segment_ids = batch[9]
     else:
       segment_ids = None
 
+    # Drop padding columns shared by the whole batch
+    input_ids = input_ids[..., :batch_length]
+    input_mask = input_mask[..., :batch_length]
+    if segment_ids is not None:
+      segment_ids = segment_ids[..., :batch_length]
+
     batch_size, num_stories, num_entities, num_sents, seq_length = input_ids.shape
 
-    with torch.no_grad():
+    with inference_mode(), torch.cuda.amp.autocast(enabled=fp16):
       # out = model(input_ids,
       #             input_lengths,
       #             input_entities,
@@ -301,91 +358,30 @@ def evaluate_tiered(model, eval_dataloader, device, metrics, seg_mode=False, ret
           if k not in agg_losses:
             agg_losses[k] = out[k]
           else:
-            agg_losses[k] += out[k]
+            agg_losses[k] = agg_losses[k] + out[k] # Inference tensors can't be updated in place outside inference mode
 
     # Get gt/predicted attributes
     if 'attributes' not in model.ablation:
-      label_ids = attributes.view(-1, attributes.shape[-1]).to('cpu').numpy()
-      if all_attributes is None:
-        all_attributes = label_ids
-      else:
-        all_attributes = np.concatenate((all_attributes, label_ids), axis=0)
-
-      preds = out['out_attributes'].detach().cpu().numpy()
-      preds[preds >= 0.5] = 1
-      preds[preds < 0.5] = 0
-      if all_pred_attributes is None:
-        all_pred_attributes = preds
-      else:
-        all_pred_attributes = np.concatenate((all_pred_attributes, preds), axis=0)
-
-
-    # Get gt/predicted preconditions
-    label_ids = preconditions.view(-1, preconditions.shape[-1]).to('cpu').numpy()
-    if all_prec is None:
-      all_prec = label_ids
-    else:
-      all_prec = np.concatenate((all_prec, label_ids), axis=0)
-
-    preds = out['out_preconditions'].detach().cpu().numpy()
-    if all_pred_prec is None:
-      all_pred_prec = preds
-    else:
-      all_pred_prec = np.concatenate((all_pred_prec, preds), axis=0)
-
+      all_attributes.append(label_batch[4].long().view(-1, attributes.shape[-1]))
+      all_pred_attributes.append((out['out_attributes'] >= 0.5).float())
 
     # Get gt/predicted preconditions
-    label_ids = effects.view(-1, effects.shape[-1]).to('cpu').numpy()
-    if all_eff is None:
-      all_eff = label_ids
-    else:
-      all_eff = np.concatenate((all_eff, label_ids), axis=0)
-
-    preds = out['out_effects'].detach().cpu().numpy()
-    if all_pred_eff is None:
-      all_pred_eff = preds
-    else:
-      all_pred_eff = np.concatenate((all_pred_eff, preds), axis=0)
+    all_prec.append(label_batch[5].long().view(-1, preconditions.shape[-1]))
+    all_pred_prec.append(out['out_preconditions'])
 
+    # Get gt/predicted effects
+    all_eff.append(label_batch[6].long().view(-1, effects.shape[-1]))
+    all_pred_eff.append(out['out_effects'])
 
     # Get gt/predicted conflict points
-    label_ids = conflicts.to('cpu').numpy()
-    if all_conflicts is None:
-      all_conflicts = label_ids
-    else:
-      all_conflicts = np.concatenate((all_conflicts, label_ids), axis=0)
-
-    # preds_start = torch.argmax(out['out_start'],dim=-1).detach().cpu().numpy()
-    # preds_end = torch.argmax(out['out_end'],dim=-1).detach().cpu().numpy()
-    # preds = np.stack((preds_start, preds_end), axis=1)
-
-    preds = out['out_conflicts'].detach().cpu().numpy()
-    preds[preds < 0.5] = 0.
-    preds[preds >= 0.5] = 1.
-    if all_pred_conflicts is None:
-      all_pred_conflicts = preds
-    else:
-      all_pred_conflicts = np.concatenate((all_pred_conflicts, preds), axis=0)
-
+    all_conflicts.append(label_batch[7].long())
+    all_pred_conflicts.append((out['out_conflicts'] >= 0.5).float())
 
     # Get gt/predicted story choices
-    label_ids = labels.to('cpu').numpy()
-    if all_stories is None:
-      all_stories = label_ids
-    else:
-      all_stories = np.concatenate((all_stories, label_ids), axis=0)
-
-    preds = torch.argmax(out['out_stories'], dim=-1).detach().cpu().numpy()
-    if all_pred_stories is None:
-      all_pred_stories = preds
-    else:
-      all_pred_stories = np.concatenate((all_pred_stories, preds), axis=0)
+    all_stories.append(label_batch[8].long())
+    all_pred_stories.append(torch.argmax(out['out_stories'], dim=-1))
     if return_softmax:
-      probs = torch.softmax(out['out_stories'], dim=-1).detach().cpu().numpy()
-      if all_prob_stories is None:
-        all_prob_stories = probs
-      else:
-        all_prob_stories = np.concatenate((all_prob_stories, probs), axis=0)
+      all_prob_stories.append(torch.softmax(out['out_stories'], dim=-1))
 
     if verbose:
       bar_idx += 1
@@ -393,6 +389,14 @@ def evaluate_tiered(model, eval_dataloader, device, metrics, seg_mode=False, ret
   if verbose:
     bar.finish()
 
+  all_pred_attributes, all_attributes = concat_to_numpy(all_pred_attributes), concat_to_numpy(all_attributes)
+  all_pred_prec, all_prec = concat_to_numpy(all_pred_prec), concat_to_numpy(all_prec)
+  all_pred_eff, all_eff = concat_to_numpy(all_pred_eff), concat_to_numpy(all_eff)
+  all_pred_conflicts, all_conflicts = concat_to_numpy(all_pred_conflicts), concat_to_numpy(all_conflicts)
+  all_pred_stories, all_stories = concat_to_numpy(all_pred_stories), concat_to_numpy(all_stories)
+  if return_softmax:
+    all_prob_stories = concat_to_numpy(all_prob_stories)
+
   # Calculate metrics
   if verbose:
     print('\t\tComputing metrics...')
@@ -459,7 +463,7 @@ def evaluate_tiered(model, eval_dataloader, device, metrics, seg_mode=False, ret
   if return_losses:
     for k in agg_losses:
       if 'loss' in k:
-        agg_losses[k] /= len(eval_dataloader)
+        agg_losses[k] = agg_losses[k] / len(eval_dataloader)
     return_base += [agg_losses]
   
   return tuple(return_base)
@@ -1,6 +1,8 @@
 import time
+import inspect
+import re
 import torch
-from www.utils import format_time
+from www.utils import format_time, get_batch_length
 import numpy as np
 from transformers import RobertaForMultipleChoice
 import progressbar
@@ -8,9 +10,67 @@ from www.model.eval import evaluate_tiered
 from sklearn.metrics import accuracy_score, f1_score
 
 
+# Set up PyTorch's AdamW with the same defaults as the (deprecated) transformers AdamW. When all parameters are on the GPU,
+# use the fused single-kernel update if this PyTorch version has it, or else the multi-tensor (foreach) one.
+def get_adamw(params, lr=1e-3, eps=1e-6, weight_decay=0.0, **kwargs):
+  params = list(params)
+  if len(params) > 0 and isinstance(params[0], dict): # Parameter groups
+    params = [dict(group, params=list(group['params'])) for group in params]
+    tensors = [p for group in params for p in group['params']]
+  else:
+    tensors = params
+  on_gpu = all(p.is_cuda and p.is_floating_point() for p in tensors)
+  supported = inspect.signature(torch.optim.AdamW).parameters
+  if on_gpu and 'fused' in supported:
+    kwargs.setdefault('fused', True)
+  elif on_gpu and 'foreach' in supported:
+    kwargs.setdefault('foreach', True)
+  return torch.optim.AdamW(params, lr=lr, eps=eps, weight_decay=weight_decay, **kwargs)
+
+
+# Freeze the embeddings and bottom num_layers encoder layers of a pre-trained transformer (e.g., RobertaModel or
+# RobertaForMultipleChoice), so no gradients are computed or stored for them. Returns the number of frozen parameters.
+def freeze_layers(model, num_layers):
+  if num_layers <= 0:
+    return 0
+  num_frozen = 0
+  for name, param in model.named_parameters():
+    layer = re.search(r'(^|\.)encoder\.layer\.(\d+)\.', name)
+    if re.search(r'(^|\.)embeddings\.', name) or (layer is not None and int(layer.group(2)) < num_layers):
+      param.requires_grad = False
+      num_frozen += param.numel()
+  return num_frozen
+
+
+# Forward hook making a module's output (or first output) require grad. Module-level so that models with the hook can
+# still be pickled.
+def require_grad_hook(module, inputs, output):
+  (output[0] if isinstance(output, tuple) else output).requires_grad_(True)
+
+
+# Turn on activation (gradient) checkpointing in a pre-trained transformer, recomputing encoder layer activations during
+# the backward pass instead of storing them, so larger batches fit in GPU memory. If freezing, call after freeze_layers
+# with the same num_frozen_layers.
+def enable_gradient_checkpointing(model, num_frozen_layers=0):
+  if hasattr(model, 'gradient_checkpointing_enable'):
+    model.gradient_checkpointing_enable()
+  else:
+    model.config.gradient_checkpointing = True # Older transformers versions check the config during forward
+  model.config.use_cache = False
+
+  # Checkpointed layers only get gradients if their inputs require grad, which isn't the case below frozen layers. Only
+  # mark the input to the first trainable layer, so frozen layers still skip recomputation and gradients in backward.
+  layers = model.base_model.encoder.layer
+  if num_frozen_layers > 0:
+    layers[min(num_frozen_layers, len(layers)) - 1].register_forward_hook(require_grad_hook)
+  elif not model.get_input_embeddings().weight.requires_grad:
+    model.get_input_embeddings().register_forward_hook(require_grad_hook)
+
+
 # Train a PyTorch model for one epoch
-def train_epoch(model, optimizer, train_dataloader, device, list_output=False, num_outputs=1, span_mode=False, seg_mode=False, classifier=None, multitask_idx=None):
+def train_epoch(model, optimizer, train_dataloader, device, list_output=False, num_outputs=1, span_mode=False, seg_mode=False, classifier=None, multitask_idx=None, scaler=None, lm=False):
   t0 = time.time()
+  fp16 = scaler is not None and scaler.is_enabled() # Mixed precision training with a torch.cuda.amp.GradScaler
 
   if not list_output:
     total_loss = 0
@@ -31,9 +91,11 @@ def train_epoch(model, optimizer, train_dataloader, device, list_output=False, n
       elapsed = format_time(time.time() - t0)
       print('\t(%s) Starting batch %s of %s.' % (elapsed, str(step), str(len(train_dataloader))))
 
-    input_ids = batch[0].to(device)
-    input_mask = batch[1].to(device)
-    labels = batch[2].to(device)
+    batch_length = get_batch_length(batch[1])
+
+    input_ids = batch[0].to(device, non_blocking=True)
+    input_mask = batch[1].to(device, non_blocking=True)
+    labels = batch[2].to(device, non_blocking=True)
 
     # if input_ids.dim() > 2:
     #   input_ids = input_ids.view(input_ids.shape[0], -1)
@@ -41,51 +103,59 @@ def train_epoch(model, optimizer, train_dataloader, device, list_output=False, n
 
     # In some cases, we also include a span for each training sequence which the model uses to classify only certain parts of the input
     if span_mode:
-      spans = batch[3].to(device)
+      spans = batch[3].to(device, non_blocking=True)
     elif seg_mode:
-      segment_ids = batch[3].to(device)
+      segment_ids = batch[3].to(device, non_blocking=True)
     else:
       spans = None
 
+    # Drop padding columns shared by the whole batch (LM labels are per-token, so keep them aligned)
+    if not lm:
+      input_ids = input_ids[..., :batch_length]
+      input_mask = input_mask[..., :batch_length]
+      if seg_mode:
+        segment_ids = segment_ids[..., :batch_length]
+
     # Forward pass
-    model.zero_grad()
-    if multitask_idx == None:
-      if span_mode:
-        out = model(input_ids, 
-              token_type_ids=None, 
-              attention_mask=input_mask, 
-              labels=labels,
-              spans=spans)
-      elif seg_mode:
-        out = model(input_ids, 
-                    token_type_ids=segment_ids, 
-                    attention_mask=input_mask, 
-                    labels=labels)
-      else:      
-        out = model(input_ids, 
-                    token_type_ids=None, 
-                    attention_mask=input_mask,
-                    labels=labels)
-    else:
-      if span_mode:
-        out = model(input_ids, 
-              token_type_ids=None, 
-              attention_mask=input_mask, 
-              labels=labels,
-              spans=spans,
-              task_idx=multitask_idx)
-      elif seg_mode:
-        out = model(input_ids, 
-                    token_type_ids=segment_ids, 
-                    attention_mask=input_mask, 
-                    labels=labels,
-                    task_idx=multitask_idx)
-      else:      
-        out = model(input_ids, 
-                    token_type_ids=None, 
-                    attention_mask=input_mask,
-                    labels=labels,
-                    task_idx=multitask_idx)                    
+    model.zero_grad(set_to_none=True)
+    with torch.cuda.amp.autocast(enabled=fp16):
+      if multitask_idx == None:
+        if span_mode:
+          out = model(input_ids, 
+                token_type_ids=None, 
+                attention_mask=input_mask, 
+                labels=labels,
+                spans=spans)
+        elif seg_mode:
+          out = model(input_ids, 
+                      token_type_ids=segment_ids, 
+                      attention_mask=input_mask, 
+                      labels=labels)
+        else:      
+          out = model(input_ids, 
+                      token_type_ids=None, 
+                      attention_mask=input_mask,
+                      labels=labels)
+      else:
+        if span_mode:
+          out = model(input_ids, 
+                token_type_ids=None, 
+                attention_mask=input_mask, 
+                labels=labels,
+                spans=spans,
+                task_idx=multitask_idx)
+        elif seg_mode:
+          out = model(input_ids, 
+                      token_type_ids=segment_ids, 
+                      attention_mask=input_mask, 
+                      labels=labels,
+                      task_idx=multitask_idx)
+        else:      
+          out = model(input_ids, 
+                      token_type_ids=None, 
+                      attention_mask=input_mask,
+                      labels=labels,
+                      task_idx=multitask_idx)
 
     if classifier != None:
       sequence_output = out[0]
@@ -104,18 +174,30 @@ def train_epoch(model, optimizer, train_dataloader, device, list_output=False, n
     else:
       loss = out[0]
 
-    # Backward pass
+    # Backward pass (losses are scaled to avoid fp16 gradient underflow if a GradScaler is given)
     if not list_output:
       total_loss += loss.item()
-      loss.backward()
+      if scaler is not None:
+        scaler.scale(loss).backward()
+      else:
+        loss.backward()
     else:
       for o in range(num_outputs):
         total_loss[o] += loss[o].item()
-        loss[o].backward()
+        if scaler is not None:
+          scaler.scale(loss[o]).backward()
+        else:
+          loss[o].backward()
 
+    if scaler is not None:
+      scaler.unscale_(optimizer) # Clip the true gradients
     torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0) # Gradient clipping
 
-    optimizer.step()
+    if scaler is not None:
+      scaler.step(optimizer)
+      scaler.update()
+    else:
+      optimizer.step()
   
   if list_output:
     return list(np.array(total_loss) / len(train_dataloader)), model
@@ -123,8 +205,9 @@ def train_epoch(model, optimizer, train_dataloader, device, list_output=False, n
     return total_loss / len(train_dataloader), model
 
 # Train a state classification pipeline for one epoch
-def train_epoch_tiered(model, optimizer, train_dataloader, device, seg_mode=False, return_losses=False, build_learning_curves=False, val_dataloader=None, train_lc_data=None, val_lc_data=None):
+def train_epoch_tiered(model, optimizer, train_dataloader, device, seg_mode=False, return_losses=False, build_learning_curves=False, val_dataloader=None, train_lc_data=None, val_lc_data=None, scaler=None):
   t0 = time.time()
+  fp16 = scaler is not None and scaler.is_enabled() # Mixed precision training with a torch.cuda.amp.GradScaler
 
   total_loss = 0
 
@@ -157,44 +240,61 @@ def train_epoch_tiered(model, optimizer, train_dataloader, device, seg_mode=Fals
       elapsed = format_time(time.time() - t0)
       print('\t(%s) Starting batch %s of %s.' % (elapsed, str(step), str(len(train_dataloader))))
 
-    input_ids = batch[0].long().to(device)
-    input_lengths = batch[1].to(device) #.to(torch.int64).to('cpu')
-    input_entities = batch[2].to(device)
-    input_mask = batch[3].to(device)
-    attributes = batch[4].long().to(device)
-    preconditions = batch[5].long().to(device)
-    effects = batch[6].long().to(device)
-    conflicts = batch[7].long().to(device)
-    labels = batch[8].long().to(device)
+    batch_length = get_batch_length(batch[3])
+
+    input_ids = batch[0].to(device, non_blocking=True).long()
+    input_lengths = batch[1].to(device, non_blocking=True) #.to(torch.int64).to('cpu')
+    input_entities = batch[2].to(device, non_blocking=True)
+    input_mask = batch[3].to(device, non_blocking=True)
+    attributes = batch[4].to(device, non_blocking=True).long()
+    preconditions = batch[5].to(device, non_blocking=True).long()
+    effects = batch[6].to(device, non_blocking=True).long()
+    conflicts = batch[7].to(device, non_blocking=True).long()
+    labels = batch[8].to(device, non_blocking=True).long()
 
     if seg_mode:
-      segment_ids = batch[8].to(device)
+      segment_ids = batch[8].to(device, non_blocking=True)
     else:
       segment_ids = None
 
+    # Drop padding columns shared by the whole batch
+    input_ids = input_ids[..., :batch_length]
+    input_mask = input_mask[..., :batch_length]
+    if segment_ids is not None:
+      segment_ids = segment_ids[..., :batch_length]
+
     # Forward pass
-    model.zero_grad()
-    out = model(input_ids, 
-                input_lengths,
-                input_entities,
-                attention_mask=input_mask,
-                token_type_ids=segment_ids,
-                attributes=attributes,
-                preconditions=preconditions,
-                effects=effects,
-                conflicts=conflicts,
-                labels=labels,
-                training=True)
+    model.zero_grad(set_to_none=True)
+    with torch.cuda.amp.autocast(enabled=fp16):
+      out = model(input_ids, 
+                  input_lengths,
+                  input_entities,
+                  attention_mask=input_mask,
+                  token_type_ids=segment_ids,
+                  attributes=attributes,
+                  preconditions=preconditions,
+                  effects=effects,
+                  conflicts=conflicts,
+                  labels=labels,
+                  training=True)
 
     loss = out['total_loss']
               
-    # Backward pass
+    # Backward pass (loss is scaled to avoid fp16 gradient underflow if a GradScaler is given)
     total_loss += loss.item()
-    loss.backward()
+    if scaler is not None:
+      scaler.scale(loss).backward()
+      scaler.unscale_(optimizer) # Clip the true gradients
+    else:
+      loss.backward()
 
     torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0) # Gradient clipping
 
-    optimizer.step()
+    if scaler is not None:
+      scaler.step(optimizer)
+      scaler.update()
+    else:
+      optimizer.step()
 
     # Build learning curve data if needed
     if build_learning_curves:
@@ -210,7 +310,7 @@ def train_epoch_tiered(model, optimizer, train_dataloader, device, seg_mode=Fals
       # Add a validation record 5 times per epoch
       chunk_size = len(train_dataloader) // 5
       if (len(train_dataloader) - step - 1) % chunk_size == 0:
-        validation_results = evaluate_tiered(model, val_dataloader, device, [(accuracy_score, 'accuracy'), (f1_score, 'f1')], seg_mode=False, return_explanations=True, return_losses=True, verbose=False)
+        validation_results = evaluate_tiered(model, val_dataloader, device, [(accuracy_score, 'accuracy'), (f1_score, 'f1')], seg_mode=False, return_explanations=True, return_losses=True, verbose=False, fp16=fp16)
         out = validation_results[16]
 
         val_record = {'epoch': len(val_lc_data) - 1,
@@ -33,6 +33,13 @@ from transformers.modeling_utils import (
 from transformers.utils import logging
 from transformers import RobertaConfig
 
+# Run parts of a model eagerly under torch.compile (no-op for PyTorch versions without TorchDynamo)
+try:
+  from torch._dynamo import disable as dynamo_disable
+except ImportError:
+  def dynamo_disable(fn):
+    return fn
+
 class DebertaForMultipleChoice(DebertaPreTrainedModel):
     def __init__(self, config):
         super().__init__(config)
@@ -164,7 +171,7 @@ class ClassificationHead(nn.Module):
 
 # Tiered model proposed for TRIP
 class TieredModelPipeline(nn.Module):
-  def __init__(self, embedding, num_sents, num_attributes, labels_per_att, config_class, model_name, device, ablation=[], loss_weights=[0.0, 0.4, 0.4, 0.2, 0.0]): # labels_per_att is a dictionary mapping attribute index to number of labels
+  def __init__(self, embedding, num_sents, num_attributes, labels_per_att, config_class, model_name, device, ablation=[], loss_weights=[0.0, 0.4, 0.4, 0.2, 0.0], pack_inputs=False, pack_length=128): # labels_per_att is a dictionary mapping attribute index to number of labels
     super().__init__()
 
     # Embedding and dropout
@@ -244,6 +251,134 @@ class TieredModelPipeline(nn.Module):
     self.ablation = ablation
     self.loss_weights = loss_weights
 
+    # In eval mode, pack several entity-sentence inputs into each sequence of up to pack_length tokens for the embedding
+    # (BERT and RoBERTa only)
+    self.pack_inputs = pack_inputs
+    self.pack_length = pack_length
+
+  # Embed flattened entity-sentence inputs, returning the first token (<s> or [CLS]) embedding of each
+  def embed(self, input_ids, attention_mask=None, token_type_ids=None):
+    if token_type_ids is not None:
+      out = self.embedding(
+              input_ids,
+              attention_mask=attention_mask,
+              token_type_ids=token_type_ids,
+              output_hidden_states=False)
+    else:
+      out = self.embedding(
+              input_ids,
+              attention_mask=attention_mask,
+              output_hidden_states=False)
+
+    if len(out[0].shape) < 3:
+      out[0] = out[0].unsqueeze(0)
+    return out[0][:,0,:]
+
+  # Padded entities and sentences are all-zero rows, which all get the same embedding in eval mode. Embed the real rows
+  # and a single padding row in one forward pass, then share that padding row's embedding with the rest of the padding.
+  # Runs eagerly, since its data-dependent shapes would make torch.compile graph break and recompile for new batches.
+  @dynamo_disable
+  def embed_unique_rows(self, input_ids, attention_mask=None, token_type_ids=None):
+    pad_rows = (input_ids == 0).all(dim=-1)
+    if attention_mask is not None:
+      pad_rows &= (attention_mask == 0).all(dim=-1)
+    if token_type_ids is not None:
+      pad_rows &= (token_type_ids == 0).all(dim=-1)
+    real_idx = (~pad_rows).nonzero(as_tuple=True)[0]
+    pad_idx = pad_rows.nonzero(as_tuple=True)[0]
+
+    # Models pickled before packing was added won't have the attribute
+    if getattr(self, 'pack_inputs', False) and attention_mask is not None and self.embedding.config.model_type in ['bert', 'roberta']:
+      emb = self.embed_packed(input_ids[real_idx],
+                              attention_mask[real_idx],
+                              token_type_ids=token_type_ids[real_idx] if token_type_ids is not None else None)
+      if len(pad_idx) > 0:
+        emb = torch.cat((emb, self.embed(input_ids[pad_idx[:1]],
+                                         attention_mask=attention_mask[pad_idx[:1]],
+                                         token_type_ids=token_type_ids[pad_idx[:1]] if token_type_ids is not None else None)), dim=0)
+    else:
+      idx = torch.cat((real_idx, pad_idx[:1]))
+      emb = self.embed(input_ids[idx],
+                       attention_mask=attention_mask[idx] if attention_mask is not None else None,
+                       token_type_ids=token_type_ids[idx] if token_type_ids is not None else None)
+
+    out = emb.new_empty((input_ids.shape[0], emb.shape[-1]))
+    out[real_idx] = emb[:len(real_idx)]
+    if len(pad_idx) > 0:
+      out[pad_idx] = emb[-1]
+    return out
+
+  # Pack consecutive (right-padded) rows into sequences of up to pack_length tokens, with a block-diagonal attention mask
+  # so that packed rows can't attend to each other and position ids restarting for each row. This removes most of the
+  # padding from short entity-sentence inputs. Returns the first token embedding of each row, in the original order.
+  @dynamo_disable
+  def embed_packed(self, input_ids, attention_mask, token_type_ids=None):
+    num_rows, seq_length = input_ids.shape
+    lengths = attention_mask.sum(dim=-1).long().tolist()
+
+    # RoBERTa's position ids start after the padding index
+    config = self.embedding.config
+    position_offset = config.pad_token_id + 1 if config.model_type == 'roberta' else 0
+
+    # Packed sequences can be wider than the rows, but no wider than the position embeddings allow
+    pack_length = getattr(self, 'pack_length', seq_length) # Models pickled before pack_length was added won't have it
+    pack_length = max(seq_length, min(pack_length, config.max_position_embeddings - position_offset))
+
+    # Greedily fill each packed sequence up to the packed length
+    row_packs = []
+    row_starts = []
+    pack_idx = 0
+    fill_length = 0
+    max_fill_length = 1
+    for length in lengths:
+      if fill_length + max(length, 1) > pack_length and fill_length > 0:
+        pack_idx += 1
+        fill_length = 0
+      row_packs.append(pack_idx)
+      row_starts.append(fill_length)
+      fill_length += length
+      max_fill_length = max(max_fill_length, fill_length)
+    num_packs = pack_idx + 1
+    pack_length = min(pack_length, -(-max_fill_length // 8) * 8) # Don't pad packed sequences beyond the fullest one
+
+    # Indices of every unpadded token: source (row, position) and destination (pack, column)
+    device = input_ids.device
+    lengths = torch.tensor(lengths, dtype=torch.long, device=device)
+    row_packs = torch.tensor(row_packs, dtype=torch.long, device=device)
+    row_starts = torch.tensor(row_starts, dtype=torch.long, device=device)
+    token_rows = torch.arange(num_rows, device=device).repeat_interleave(lengths)
+    token_positions = torch.arange(int(lengths.sum()), device=device) - (torch.cumsum(lengths, dim=0) - lengths).repeat_interleave(lengths)
+    token_packs = row_packs.repeat_interleave(lengths)
+    token_cols = row_starts.repeat_interleave(lengths) + token_positions
+
+    packed_ids = input_ids.new_full((num_packs, pack_length), config.pad_token_id)
+    packed_ids[token_packs, token_cols] = input_ids[token_rows, token_positions]
+
+    packed_position_ids = input_ids.new_zeros((num_packs, pack_length))
+    packed_position_ids[token_packs, token_cols] = token_positions + position_offset
+
+    packed_rows = torch.full((num_packs, pack_length), -1, dtype=torch.long, device=device)
+    packed_rows[token_packs, token_cols] = token_rows
+    packed_mask = (packed_rows.unsqueeze(-1) == packed_rows.unsqueeze(-2)) & (packed_rows.unsqueeze(-1) >= 0)
+
+    packed_token_type_ids = None
+    if token_type_ids is not None:
+      packed_token_type_ids = token_type_ids.new_zeros((num_packs, pack_length))
+      packed_token_type_ids[token_packs, token_cols] = token_type_ids[token_rows, token_positions]
+
+    out = self.embedding(
+            packed_ids.long(),
+            attention_mask=packed_mask.long(),
+            token_type_ids=packed_token_type_ids.long() if packed_token_type_ids is not None else None,
+            position_ids=packed_position_ids,
+            output_hidden_states=False)
+    return out[0][row_packs, row_starts]
+
+  # Stack per-attribute state logits into one (num attributes, num inputs, max labels) tensor, padding attributes with fewer
+  # labels with -inf so that argmax and cross entropy can run over all attributes at once without picking the padding
+  def stack_attribute_logits(self, logits):
+    max_labels = max([l.shape[-1] for l in logits])
+    return torch.stack([nn.functional.pad(l, (0, max_labels - l.shape[-1]), value=float('-inf')) for l in logits], dim=0)
 
   def forward(self, input_ids, input_lengths, input_entities, attention_mask=None, token_type_ids=None, attributes=None, preconditions=None, effects=None, conflicts=None, labels=None, training=False):
 
@@ -254,32 +389,25 @@ class TieredModelPipeline(nn.Module):
     input_lengths = input_lengths.view(-1)
     input_entities = input_entities.view(-1)
     
-    length_mask = torch.ones((batch_size * num_stories * num_entities, num_sents), requires_grad=False).to(input_lengths.device)
-    for i in range(self.num_sents):
-      length_mask[input_lengths <= i, i] = 0 # Use input lengths to zero out state and conflict preds wherever there isn't a sentence
-    length_mask = length_mask.view(batch_size*num_stories, num_entities, num_sents)
-    for i in range(num_entities):
-      length_mask[input_entities <= i, i, :] = 0 # Use input entity counts to zero out state and conflict preds wherever there isn't an entity
-    length_mask = length_mask.view(batch_size * num_stories * num_entities, num_sents)
+    # Use input lengths and entity counts to zero out state and conflict preds wherever there isn't a sentence or entity
+    sent_mask = torch.arange(num_sents, device=input_lengths.device).unsqueeze(0) < input_lengths.unsqueeze(-1)
+    entity_mask = torch.arange(num_entities, device=input_entities.device).unsqueeze(0) < input_entities.unsqueeze(-1)
+    length_mask = sent_mask.view(batch_size*num_stories, num_entities, num_sents) & entity_mask.unsqueeze(-1)
+    length_mask = length_mask.view(batch_size * num_stories * num_entities, num_sents).float()
 
     # 1) Embed the inputs
+    flat_input_ids = input_ids.view(batch_size * num_stories * num_entities * num_sents, -1).long()
+    flat_attention_mask = attention_mask.view(batch_size * num_stories * num_entities * num_sents, -1) if attention_mask is not None else None
+    flat_token_type_ids = None
     if token_type_ids is not None:
       print(token_type_ids)
       print(token_type_ids.shape)
-      out = self.embedding(
-              input_ids.view(batch_size * num_stories * num_entities * num_sents, -1).long(),
-              attention_mask=attention_mask.view(batch_size * num_stories * num_entities * num_sents, -1) if attention_mask is not None else None,
-              token_type_ids=token_type_ids.view(batch_size * num_stories * num_entities * num_sents, -1),
-              output_hidden_states=False)
+      flat_token_type_ids = token_type_ids.view(batch_size * num_stories * num_entities * num_sents, -1)
+
+    if self.embedding.training:
+      out = self.embed(flat_input_ids, attention_mask=flat_attention_mask, token_type_ids=flat_token_type_ids) # entity-sentence embeddings
     else:
-      out = self.embedding(
-              input_ids.view(batch_size * num_stories * num_entities * num_sents, -1).long(),
-              attention_mask=attention_mask.view(batch_size * num_stories * num_entities * num_sents, -1) if attention_mask is not None else None,
-              output_hidden_states=False)
-      
-    if len(out[0].shape) < 3:
-      out[0] = out[0].unsqueeze(0)
-    out = out[0][:,0,:] # entity-sentence embeddings
+      out = self.embed_unique_rows(flat_input_ids, attention_mask=flat_attention_mask, token_type_ids=flat_token_type_ids)
 
 
     # 2) State classification
@@ -307,25 +435,28 @@ class TieredModelPipeline(nn.Module):
     if preconditions is not None:
       loss_preconditions = 0.0
 
-    out_preconditions = torch.zeros((batch_size * num_stories * num_entities * num_sents, self.num_attributes)).to(self.embedding.device)
-    out_preconditions_softmax = torch.tensor([]).to(self.embedding.device)
+    out_preconditions_logits = []
+    out_preconditions_softmax = []
     for i in range(self.num_attributes):
       out_s = self.precondition_classifiers[i](out, return_embeddings=False)
 
-      with torch.no_grad(): # Don't allow backprop from conflict detection to state classifiers
-        out_preconditions_softmax = torch.cat((out_preconditions_softmax, out_s), dim=-1)
+      # Don't allow backprop from conflict detection to state classifiers (copy if out_s is about to be modified in place)
+      out_preconditions_softmax.append(out_s.detach().clone() if 'attributes' not in self.ablation else out_s.detach())
 
       if 'attributes' not in self.ablation:
         # If attribute classifier predicted 0, zero out positive classes and vice versa
         out_s[:, 0] *= (1 - out_a[:, i])
-        out_s[:, 1:] *= out_a[:, i].repeat(self.labels_per_att[i]-1,1).t()
-
-      out_preconditions[:, i] = torch.argmax(out_s, dim=1) # Extract predicted value
+        out_s[:, 1:] *= out_a[:, i:i+1]
+      out_preconditions_logits.append(out_s)
+    out_preconditions_softmax = torch.cat(out_preconditions_softmax, dim=-1)
 
-      if preconditions is not None:
-        loss_preconditions += loss_fct(out_s.view(-1, self.precondition_classifiers[i].num_labels), preconditions[:, :, :, :, i].view(-1))
+    # Extract predicted values and sum the per-attribute losses for all attributes at once
+    out_preconditions_logits = self.stack_attribute_logits(out_preconditions_logits)
+    out_preconditions = torch.argmax(out_preconditions_logits, dim=-1).t().float()
+    if preconditions is not None:
+      loss_preconditions = loss_fct(out_preconditions_logits.view(-1, out_preconditions_logits.shape[-1]), preconditions.view(-1, self.num_attributes).t().reshape(-1)) * self.num_attributes
 
-    out_preconditions *= length_mask.view(-1).repeat(self.num_attributes, 1).t() # Mask out any nonexistent entities or sentences
+    out_preconditions *= length_mask.view(-1, 1) # Mask out any nonexistent entities or sentences (broadcast over attributes)
     assert length_mask.view(-1).shape[0] == out_preconditions.shape[0]
     return_dict['out_preconditions'] = out_preconditions # * length_mask.view(-1).repeat(self.num_attributes, 1).t()
     if preconditions is not None:
@@ -338,24 +469,28 @@ class TieredModelPipeline(nn.Module):
     if effects is not None:
       loss_effects = 0.0
 
-    out_effects = torch.zeros((batch_size * num_stories * num_entities * num_sents, self.num_attributes)).to(self.embedding.device)
-    out_effects_softmax = torch.tensor([]).to(self.embedding.device)
+    out_effects_logits = []
+    out_effects_softmax = []
     for i in range(self.num_attributes):
       out_s = self.effect_classifiers[i](out, return_embeddings=False)
-      with torch.no_grad(): # Don't allow backprop from conflict detection to state classifiers
-        out_effects_softmax = torch.cat((out_effects_softmax, out_s), dim=-1)
+
+      # Don't allow backprop from conflict detection to state classifiers (copy if out_s is about to be modified in place)
+      out_effects_softmax.append(out_s.detach().clone() if 'attributes' not in self.ablation else out_s.detach())
 
       if 'attributes' not in self.ablation:
         # If attribute classifier predicted 0, zero out positive classes and vice versa
         out_s[:, 0] *= (1 - out_a[:, i])
-        out_s[:, 1:] *= out_a[:, i].repeat(self.labels_per_att[i]-1,1).t()
+        out_s[:, 1:] *= out_a[:, i:i+1]
+      out_effects_logits.append(out_s)
+    out_effects_softmax = torch.cat(out_effects_softmax, dim=-1)
 
-      out_effects[:, i] = torch.argmax(out_s, dim=1) # Extract predicted value
+    # Extract predicted values and sum the per-attribute losses for all attributes at once
+    out_effects_logits = self.stack_attribute_logits(out_effects_logits)
+    out_effects = torch.argmax(out_effects_logits, dim=-1).t().float()
+    if effects is not None:
+      loss_effects = loss_fct(out_effects_logits.view(-1, out_effects_logits.shape[-1]), effects.view(-1, self.num_attributes).t().reshape(-1)) * self.num_attributes
 
-      if effects is not None:
-        loss_effects += loss_fct(out_s.view(-1, self.effect_classifiers[i].num_labels), effects[:, :, :, :, i].view(-1))
-    
-    out_effects *= length_mask.view(-1).repeat(self.num_attributes, 1).t() # Mask out any nonexistent entities or sentences
+    out_effects *= length_mask.view(-1, 1) # Mask out any nonexistent entities or sentences (broadcast over attributes)
     assert length_mask.view(-1).shape[0] == out_effects.shape[0]      
     return_dict['out_effects'] = out_effects # * length_mask.view(-1).repeat(self.num_attributes, 1).t()
     if effects is not None:
@@ -395,7 +530,7 @@ class TieredModelPipeline(nn.Module):
       out = torch.cat((out, out_states), dim=-1)
 
     # Pad with a few zeros
-    out = torch.cat((out, torch.zeros(out.shape[:-1] + (self.encoding_pad_zeros,)).to(self.embedding.device)), dim=-1)
+    out = nn.functional.pad(out, (0, self.encoding_pad_zeros))
     out = out.view(batch_size * num_stories * num_entities, num_sents, -1)
 
     # Run through transformer
@@ -413,7 +548,8 @@ class TieredModelPipeline(nn.Module):
     loss_conflicts = None
     if conflicts is not None:
       loss_fct = BCELoss()
-      loss_conflicts = loss_fct(out, conflicts.view(batch_size*num_stories*num_entities, -1).float())
+      with torch.cuda.amp.autocast(enabled=False): # BCELoss is unsafe to autocast, so compute it in full precision
+        loss_conflicts = loss_fct(out.float(), conflicts.view(batch_size*num_stories*num_entities, -1).float())
 
       return_dict['loss_conflicts'] = loss_conflicts
 
@@ -8,6 +8,8 @@ import csv
 import sys
 import pickle
 import os
+import numpy as np
+from torch.utils.data import Sampler
 
 def print_dict(ex):
   print('{')
@@ -62,4 +64,34 @@ def get_sublist(l, sl):
         idx.append(i+j)
       return idx
   return [] # If we made it here, sublist is not within list
-      
\ No newline at end of file
+      
+
+# Returns the number of unpadded tokens in each example of a tensor dataset (longest choice for multiple-choice inputs)
+def get_input_lengths(tensor_dataset, mask_idx=1):
+  input_mask = tensor_dataset.tensors[mask_idx]
+  input_mask = input_mask.view(input_mask.shape[0], -1, input_mask.shape[-1])
+  return input_mask.sum(dim=-1).max(dim=-1)[0].long().numpy()
+
+# Returns the length of the longest unpadded sequence in a batch, so padding columns shared by the whole batch can be dropped.
+# Rounded up to a multiple of 8 (within the padded length) so that fp16 matmuls stay on the tensor core fast path.
+def get_batch_length(input_mask, multiple_of=8):
+  length = int(input_mask.view(-1, input_mask.shape[-1]).sum(dim=-1).max())
+  length = -(-length // multiple_of) * multiple_of
+  return min(length, input_mask.shape[-1])
+
+# Sequential sampler which visits examples from shortest to longest, so each batch needs little padding
+class LengthSortedSampler(Sampler):
+  def __init__(self, lengths):
+    self.order = np.argsort(lengths, kind='stable')
+
+  def __iter__(self):
+    return iter(self.order.tolist())
+
+  def __len__(self):
+    return len(self.order)
+
+  # Puts an array of per-example outputs collected in sampler order back into dataset order
+  def restore_order(self, outputs):
+    restored = np.empty_like(outputs)
+    restored[self.order] = outputs
+    return restored